@@ -1,7 +1,8 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response
 import os
 import csv
 import io
+import json
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-change-this')
@@ -12,20 +13,82 @@ from utils.spotify_api import (
     get_current_playback, get_tracks_from_playlist,
     detect_duplicate_liked_songs, unlike_track, merge_all_duplicates,
     create_genre_playlists, get_available_genres,
-    get_song_statistics, get_smart_recommendations
+    get_song_statistics, get_smart_recommendations, get_liked_songs_version
 )
 from utils.genre_cache import enrich_tracks_with_cached_genres
+from utils.audio_features import (
+    get_audio_analysis, get_similar_tracks, create_mood_playlists, MIN_CLUSTERS, MAX_CLUSTERS
+)
+from utils.smart_playlists import (
+    parse_rule, compile_rule, list_smart_playlists, create_smart_playlist,
+    delete_smart_playlist, sync_smart_playlists
+)
+from utils.session_store import create_session, delete_session, get_session_token
+from utils.response_cache import (
+    make_cache_key, get_cached, put_cached, pick_encoding, encoded_body,
+    compress, MIN_COMPRESS_SIZE
+)
+
+def current_token():
+    """Token for the logged-in user; the cookie only carries the session ID"""
+    sid = session.get('sid')
+    return get_session_token(sid) if sid else None
+
+def cached_response(key, render, mimetype='text/html'):
+    """Serve a rendered body from the versioned cache, answering 304 when the ETag matches.
+
+    `key` already encodes the library version, so it is used as the ETag and a
+    matching If-None-Match skips both the cache lookup and the render.
+    """
+    if session.get('_flashes'):
+        # Pending flash messages are consumed by the template; never cache them
+        return Response(render(), mimetype=mimetype)
+    if request.if_none_match.contains_weak(key):
+        resp = Response(status=304)
+    else:
+        entry = get_cached(key)
+        if entry is None:
+            body = render()
+            entry = put_cached(key, body.encode('utf-8') if isinstance(body, str) else body, mimetype)
+        data, enc = encoded_body(entry, pick_encoding(request.headers.get('Accept-Encoding')))
+        resp = Response(data, mimetype=entry['mimetype'])
+        if enc:
+            resp.headers['Content-Encoding'] = enc
+    # Weak: the same validator covers the gzip, br and identity encodings
+    resp.set_etag(key, weak=True)
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+@app.after_request
+def compress_response(resp):
+    """gzip/brotli large HTML and JSON responses that were not served from the cache"""
+    if (resp.direct_passthrough or resp.status_code != 200
+            or 'Content-Encoding' in resp.headers
+            or resp.mimetype not in ('text/html', 'application/json')):
+        return resp
+    enc = pick_encoding(request.headers.get('Accept-Encoding'))
+    if not enc:
+        return resp
+    body = resp.get_data()
+    if len(body) < MIN_COMPRESS_SIZE:
+        return resp
+    resp.set_data(compress(body, enc))
+    resp.headers['Content-Encoding'] = enc
+    resp.vary.add('Accept-Encoding')
+    return resp
 
 # Song Statistics page
 @app.route('/song-stats')
 def song_stats():
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return redirect(url_for('login'))
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         u = sp.current_user()
         p = request.args.get('period', 'all')
-        s = get_song_statistics(sp, p)
+        s = get_song_statistics(sp, p, user_id=u['id'])
         return render_template('song_stats.html', user=u, stats=s, period=p)
     except Exception as e:
         flash(f'Error loading statistics: {str(e)}', 'error')
@@ -34,10 +97,11 @@ def song_stats():
 # Smart Recommendations page
 @app.route('/recommendations')
 def recommendations():
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return redirect(url_for('login'))
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         u = sp.current_user()
         r = get_smart_recommendations(sp, limit=10)
         return render_template('recommendations.html', user=u, recs=r)
@@ -45,12 +109,45 @@ def recommendations():
         flash(f'Error loading recommendations: {str(e)}', 'error')
         return redirect(url_for('index'))
 
+# Audio Analysis page
+@app.route('/audio-analysis')
+def audio_analysis():
+    token_info = current_token()
+    if not token_info:
+        return redirect(url_for('login'))
+    try:
+        sp = get_spotify_client(token_info)
+        u = sp.current_user()
+        k = max(MIN_CLUSTERS, min(request.args.get('clusters', 4, type=int), MAX_CLUSTERS))
+        a = get_audio_analysis(sp, u['id'], k=k)
+        return render_template('audio_analysis.html', user=u, analysis=a, clusters=k,
+                               cluster_range=range(MIN_CLUSTERS, MAX_CLUSTERS + 1))
+    except Exception as e:
+        flash(f'Error loading audio analysis: {str(e)}', 'error')
+        return redirect(url_for('index'))
+
+# Smart Playlists page
+@app.route('/smart-playlists')
+def smart_playlists():
+    token_info = current_token()
+    if not token_info:
+        return redirect(url_for('login'))
+    try:
+        sp = get_spotify_client(token_info)
+        u = sp.current_user()
+        r = list_smart_playlists(u['id'])
+        return render_template('smart_playlists.html', user=u, rules=r)
+    except Exception as e:
+        flash(f'Error loading smart playlists: {str(e)}', 'error')
+        return redirect(url_for('index'))
+
 @app.route('/')
 def index():
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return render_template('login.html')
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         u = sp.current_user()
         pls = get_user_playlists(sp)
         ls = get_user_liked_songs(sp, limit=20)
@@ -72,12 +169,14 @@ def login():
 def callback():
     """Handle Spotify OAuth callback"""
     sp_oauth = get_spotify_oauth()
+    if session.get('sid'):
+        delete_session(session['sid'])
     session.clear()
     code = request.args.get('code')
     
     try:
         token_info = sp_oauth.get_access_token(code)
-        session['token_info'] = token_info
+        session['sid'] = create_session(token_info)
         return redirect(url_for('index'))
     except Exception as e:
         flash(f'Authentication failed: {str(e)}', 'error')
@@ -86,6 +185,8 @@ def callback():
 @app.route('/logout')
 def logout():
     """Logout and clear session"""
+    if session.get('sid'):
+        delete_session(session['sid'])
     session.clear()
     return redirect(url_for('index'))
 
@@ -93,44 +194,46 @@ def logout():
 
 @app.route('/playlist/<playlist_id>', methods=['GET'])
 def view_playlist(playlist_id):
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return redirect(url_for('login'))
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         u = sp.current_user()
-        pl = sp.playlist(playlist_id)
-        trks = get_tracks_from_playlist(sp, playlist_id)
         y = request.args.get('year')
         pop = request.args.get('popularity')
         ex = request.args.get('explicit')
-        ftr = []
-        for i in trks:
-            t = i.get('track')
-            if not t:
-                continue
-            if y and t.get('album', {}).get('release_date', '')[:4] != str(y):
-                continue
-            if pop and t.get('popularity', 0) < int(pop):
-                continue
-            if ex == 'true' and not t.get('explicit', False):
-                continue
-            if ex == 'false' and t.get('explicit', False):
-                continue
-            ftr.append(i)
-        if not (y or pop or ex):
-            ftr = trks
-        trks2 = enrich_tracks_with_cached_genres(sp, ftr)
-        return render_template('playlist_detail.html', user=u, playlist=pl, tracks=trks2)
+        snap = sp.playlist(playlist_id, fields='snapshot_id')['snapshot_id']
+        key = make_cache_key('playlist', u['id'], playlist_id, snap, y, pop, ex)
+
+        def render():
+            pl = sp.playlist(playlist_id)
+            trks = get_tracks_from_playlist(sp, playlist_id)
+            if y or pop or ex:
+                keep = compile_rule({
+                    'year_min': int(y) if y else None,
+                    'year_max': int(y) if y else None,
+                    'popularity_min': int(pop) if pop else None,
+                    'explicit': {'true': True, 'false': False}.get(ex)
+                })
+                ftr = [i for i in trks if keep(i, [])]
+            else:
+                ftr = trks
+            trks2 = enrich_tracks_with_cached_genres(sp, ftr)
+            return render_template('playlist_detail.html', user=u, playlist=pl, tracks=trks2)
+
+        return cached_response(key, render)
     except Exception as e:
         flash(f'Error loading playlist: {str(e)}', 'error')
         return redirect(url_for('index'))
 
 @app.route('/playlist/<playlist_id>/export/<format>')
 def export_playlist(playlist_id, format):
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return redirect(url_for('login'))
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         playlist = sp.playlist(playlist_id)
         tracks = get_tracks_from_playlist(sp, playlist_id)
         # Prepare data
@@ -166,10 +269,11 @@ def export_playlist(playlist_id, format):
 
 @app.route('/playlist/<playlist_id>/import', methods=['POST'])
 def import_playlist(playlist_id):
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return redirect(url_for('login'))
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         file = request.files.get('import_file')
         if not file:
             flash('No file uploaded', 'error')
@@ -201,20 +305,27 @@ def import_playlist(playlist_id):
 @app.route('/liked-songs')
 def view_liked_songs():
     """View detailed liked songs"""
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return redirect(url_for('login'))
     
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         user_info = sp.current_user()
-        liked_songs = get_user_liked_songs(sp)  # Fetch all liked songs
+        key = make_cache_key('liked-songs', user_info['id'], get_liked_songs_version(sp))
         
-        # Enrich tracks with genre information
-        enriched_liked_songs = enrich_tracks_with_cached_genres(sp, liked_songs)
+        def render():
+            # strict: a truncated listing must fail rather than be cached under this version
+            liked_songs = get_user_liked_songs(sp, strict=True)
+            
+            # Enrich tracks with genre information
+            enriched_liked_songs = enrich_tracks_with_cached_genres(sp, liked_songs)
+            
+            return render_template('liked_songs_detail.html', 
+                                 user=user_info,
+                                 liked_songs=enriched_liked_songs)
         
-        return render_template('liked_songs_detail.html', 
-                             user=user_info,
-                             liked_songs=enriched_liked_songs)
+        return cached_response(key, render)
     except Exception as e:
         flash(f'Error loading liked songs: {str(e)}', 'error')
         return redirect(url_for('index'))
@@ -222,17 +333,23 @@ def view_liked_songs():
 @app.route('/detect-duplicates')
 def detect_duplicates():
     """Detect duplicate songs in liked songs"""
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return redirect(url_for('login'))
     
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         user_info = sp.current_user()
-        duplicates = detect_duplicate_liked_songs(sp)
+        key = make_cache_key('duplicates', user_info['id'], get_liked_songs_version(sp))
         
-        return render_template('duplicates.html', 
-                             user=user_info,
-                             duplicates=duplicates)
+        def render():
+            duplicates = detect_duplicate_liked_songs(sp, strict=True)
+            
+            return render_template('duplicates.html', 
+                                 user=user_info,
+                                 duplicates=duplicates)
+        
+        return cached_response(key, render)
     except Exception as e:
         flash(f'Error detecting duplicates: {str(e)}', 'error')
         return redirect(url_for('index'))
@@ -240,11 +357,12 @@ def detect_duplicates():
 @app.route('/genre-filter')
 def genre_filter():
     """Genre filtering and playlist creation page"""
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return redirect(url_for('login'))
     
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         user_info = sp.current_user()
         
         return render_template('genre_filter.html', user=user_info)
@@ -255,11 +373,12 @@ def genre_filter():
 @app.route('/api/current-playback')
 def api_current_playback():
     """API endpoint to get current playback info"""
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         playback = get_current_playback(sp)
         
         return jsonify({
@@ -271,7 +390,8 @@ def api_current_playback():
 @app.route('/api/unlike-track', methods=['POST'])
 def api_unlike_track():
     """API endpoint to unlike a track"""
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
@@ -281,7 +401,7 @@ def api_unlike_track():
         if not track_id:
             return jsonify({'error': 'Track ID is required'}), 400
         
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         success = unlike_track(sp, track_id)
         
         if success:
@@ -295,11 +415,12 @@ def api_unlike_track():
 @app.route('/api/merge-all-duplicates', methods=['POST'])
 def api_merge_all_duplicates():
     """API endpoint to merge all duplicates by keeping the first instance of each"""
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         result = merge_all_duplicates(sp)
         
         return jsonify({
@@ -315,11 +436,12 @@ def api_merge_all_duplicates():
 @app.route('/api/available-genres')
 def api_available_genres():
     """API endpoint to get all available genres from liked songs"""
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         genres = get_available_genres(sp)
         return jsonify({'genres': genres})
     except Exception as e:
@@ -328,14 +450,15 @@ def api_available_genres():
 @app.route('/api/create-genre-playlists', methods=['POST'])
 def api_create_genre_playlists():
     """API endpoint to create genre-based playlists"""
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
         data = request.get_json()
         genre_filter = data.get('genre_filter') if data else None
         
-        sp = get_spotify_client(session['token_info'])
+        sp = get_spotify_client(token_info)
         result = create_genre_playlists(sp, genre_filter)
         
         return jsonify({
@@ -349,16 +472,125 @@ def api_create_genre_playlists():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/similar-tracks/<track_id>')
+def api_similar_tracks(track_id):
+    """API endpoint to get the closest liked songs by audio features"""
+    token_info = current_token()
+    if not token_info:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    try:
+        sp = get_spotify_client(token_info)
+        user_info = sp.current_user()
+        tracks = get_similar_tracks(sp, user_info['id'], track_id, n=request.args.get('limit', 10, type=int))
+        return jsonify({'tracks': tracks})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/create-mood-playlists', methods=['POST'])
+def api_create_mood_playlists():
+    """API endpoint to create playlists from audio-feature mood clusters"""
+    token_info = current_token()
+    if not token_info:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    try:
+        data = request.get_json(silent=True) or {}
+        k = max(MIN_CLUSTERS, min(int(data.get('clusters', 4)), MAX_CLUSTERS))
+        
+        sp = get_spotify_client(token_info)
+        result = create_mood_playlists(sp, k)
+        
+        return jsonify({
+            'success': True,
+            'playlists_created': result['playlists_created'],
+            'playlists': result['playlists'],
+            'total_clusters': result['total_clusters'],
+            'message': f'Successfully created {result["playlists_created"]} mood playlists!'
+        })
+            
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/smart-playlists', methods=['POST'])
+def api_create_smart_playlist():
+    """API endpoint to create a rule-based smart playlist"""
+    token_info = current_token()
+    if not token_info:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    try:
+        data = request.get_json() or {}
+        name = (data.get('name') or '').strip()
+        if not name:
+            return jsonify({'error': 'Playlist name is required'}), 400
+        try:
+            rule = parse_rule(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        sp = get_spotify_client(token_info)
+        result = create_smart_playlist(sp, name, rule)
+        if not result:
+            return jsonify({'error': 'Failed to create playlist'}), 500
+        
+        return jsonify({
+            'success': True,
+            'smart_playlist': result,
+            'message': f'Created smart playlist "{name}" with {result["track_count"]} tracks'
+        })
+            
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/smart-playlists/<rule_id>', methods=['DELETE'])
+def api_delete_smart_playlist(rule_id):
+    """API endpoint to stop syncing a smart playlist"""
+    token_info = current_token()
+    if not token_info:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    try:
+        sp = get_spotify_client(token_info)
+        user_info = sp.current_user()
+        if not delete_smart_playlist(user_info['id'], rule_id):
+            return jsonify({'error': 'Smart playlist not found'}), 404
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/smart-playlists/sync', methods=['POST'])
+def api_sync_smart_playlists():
+    """API endpoint to apply new liked songs to all smart playlists"""
+    token_info = current_token()
+    if not token_info:
+        return jsonify({'error': 'Not authenticated'}), 401
+    
+    try:
+        sp = get_spotify_client(token_info)
+        user_info = sp.current_user()
+        result = sync_smart_playlists(sp, user_info['id'])
+        
+        return jsonify({
+            'success': True,
+            **result,
+            'message': f'Synced {result["rules"]} smart playlists: {result["tracks_added"]} added, {result["tracks_removed"]} removed'
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/album/<album_id>')
 def api_album_details(album_id):
     """API endpoint to get album details"""
-    if 'token_info' not in session:
+    token_info = current_token()
+    if not token_info:
         return jsonify({'error': 'Not authenticated'}), 401
     
     try:
-        sp = get_spotify_client(session['token_info'])
-        album = sp.album(album_id)
-        return jsonify(album)
+        # Album metadata does not depend on the user or change once published
+        key = make_cache_key('album', album_id)
+        sp = get_spotify_client(token_info)
+        return cached_response(key, lambda: json.dumps(sp.album(album_id)), mimetype='application/json')
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
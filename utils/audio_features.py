@@ -0,0 +1,407 @@
+import json
+import os
+from typing import List, Dict, Optional, Tuple
+import numpy as np
+import spotipy
+
+from .file_store import atomic_write, atomic_write_json, file_lock
+from .spotify_api import (
+    get_user_liked_songs, get_liked_songs_version,
+    create_playlist, add_tracks_to_playlist
+)
+
+BASE_DIR = os.path.dirname(os.path.dirname(__file__))
+FEATURE_FILE = os.path.join(BASE_DIR, 'audio_features.npz')
+LIBRARY_FILE = os.path.join(BASE_DIR, 'audio_libraries.json')
+
+FEATURES = [
+    'danceability', 'energy', 'valence', 'tempo', 'loudness',
+    'acousticness', 'instrumentalness', 'speechiness', 'liveness'
+]
+# Columns used for mood clustering and "more like this"
+MOOD_FEATURES = ['danceability', 'energy', 'valence', 'tempo', 'acousticness']
+DISTRIBUTION_FEATURES = ['tempo', 'energy', 'valence', 'danceability']
+
+BATCH_SIZE = 100
+# Mood cluster counts offered by the page and accepted by the API
+MIN_CLUSTERS = 2
+MAX_CLUSTERS = 12
+
+_cache = {'mtime': None}
+_analysis_memo = {}
+
+
+def _empty_cache() -> Dict:
+    return {
+        'mtime': None,
+        'ids': [],
+        'index': {},
+        'matrix': np.empty((0, len(FEATURES)), dtype=np.float32),
+        'names': [],
+        'artists': [],
+        'uris': []
+    }
+
+
+def load_feature_cache(force: bool = False) -> Dict:
+    """Feature matrix for every track ever ingested, reloaded only when the file changes"""
+    global _cache
+    if not os.path.exists(FEATURE_FILE):
+        if 'matrix' not in _cache:
+            _cache = _empty_cache()
+        return _cache
+
+    mtime = os.path.getmtime(FEATURE_FILE)
+    if _cache['mtime'] == mtime and not force:
+        return _cache
+
+    try:
+        with np.load(FEATURE_FILE) as data:
+            ids = data['ids'].tolist()
+            _cache = {
+                'mtime': mtime,
+                'ids': ids,
+                'index': {tid: i for i, tid in enumerate(ids)},
+                'matrix': data['matrix'].astype(np.float32),
+                'names': data['names'].tolist(),
+                'artists': data['artists'].tolist(),
+                'uris': data['uris'].tolist()
+            }
+    except Exception as e:
+        print(f"Error loading audio feature cache, starting with empty cache: {e}")
+        _cache = _empty_cache()
+    return _cache
+
+
+def save_feature_cache(cache: Dict) -> None:
+    """Replace the feature file; callers hold file_lock(FEATURE_FILE)"""
+    global _cache
+    try:
+        atomic_write(FEATURE_FILE, lambda f: np.savez(
+            f,
+            ids=np.array(cache['ids'], dtype=str),
+            matrix=cache['matrix'],
+            names=np.array(cache['names'], dtype=str),
+            artists=np.array(cache['artists'], dtype=str),
+            uris=np.array(cache['uris'], dtype=str)
+        ))
+        cache['mtime'] = os.path.getmtime(FEATURE_FILE)
+        _cache = cache
+        print(f"Audio feature cache saved to {FEATURE_FILE} with {len(cache['ids'])} tracks")
+    except Exception as e:
+        print(f"Error saving audio feature cache: {e}")
+
+
+def load_libraries() -> Dict[str, Dict]:
+    if os.path.exists(LIBRARY_FILE):
+        try:
+            with open(LIBRARY_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, FileNotFoundError):
+            print("Error loading audio library index, starting with empty index")
+    return {}
+
+
+def save_library(user_id: str, library: Dict) -> None:
+    # Re-read under the lock so other workers' users are not overwritten
+    try:
+        with file_lock(LIBRARY_FILE):
+            libraries = load_libraries()
+            libraries[user_id] = library
+            atomic_write_json(LIBRARY_FILE, libraries)
+    except Exception as e:
+        print(f"Error saving audio library index: {e}")
+
+
+def _append_features(rows: List[List[float]], tracks: List[Dict]) -> Dict:
+    """Merge new rows into the on-disk matrix under the file lock.
+
+    Reloading inside the lock keeps rows another worker saved in the
+    meantime, and rows it already added are not duplicated.
+    """
+    with file_lock(FEATURE_FILE):
+        cache = load_feature_cache(force=True)
+        keep = [j for j, tr in enumerate(tracks) if tr['id'] not in cache['index']]
+        if not keep:
+            return cache
+
+        start = len(cache['ids'])
+        ids = [tracks[j]['id'] for j in keep]
+        new = {
+            'mtime': cache['mtime'],
+            'ids': cache['ids'] + ids,
+            'index': dict(cache['index']),
+            'matrix': np.vstack([cache['matrix'], np.array([rows[j] for j in keep], dtype=np.float32)]),
+            'names': cache['names'] + [tracks[j].get('name') or '' for j in keep],
+            'artists': cache['artists'] + [tracks[j]['artists'][0]['name'] if tracks[j].get('artists') else '' for j in keep],
+            'uris': cache['uris'] + [tracks[j].get('uri') or '' for j in keep]
+        }
+        new['index'].update({tid: start + j for j, tid in enumerate(ids)})
+        save_feature_cache(new)
+        return new
+
+
+def ingest_audio_features(sp: spotipy.Spotify, tracks: List[Dict]) -> Tuple[Dict, int]:
+    """Fetch features for tracks not yet in the cache, 100 IDs per request.
+
+    Tracks Spotify has no features for are stored as NaN rows so they are
+    not requested again. Returns the cache and the number of failed
+    batches, whose tracks stay missing and are retried on the next sync.
+    """
+    cache = load_feature_cache()
+    seen = set()
+    missing = []
+    for tr in tracks:
+        tid = tr.get('id')
+        if tid and tid not in cache['index'] and tid not in seen:
+            seen.add(tid)
+            missing.append(tr)
+
+    if not missing:
+        return cache, 0
+
+    rows, fetched = [], []
+    failed = 0
+    for i in range(0, len(missing), BATCH_SIZE):
+        batch = missing[i:i + BATCH_SIZE]
+        try:
+            res = sp.audio_features([tr['id'] for tr in batch]) or []
+        except Exception as e:
+            print(f"Error fetching audio features batch at {i}: {e}")
+            failed += 1
+            continue
+        for tr, feat in zip(batch, res):
+            rows.append([feat.get(k, np.nan) if feat else np.nan for k in FEATURES])
+            fetched.append(tr)
+
+    if not fetched:
+        return cache, failed
+
+    cache = _append_features(rows, fetched)
+    print(f"Fetched audio features for {len(fetched)} new tracks")
+    return cache, failed
+
+
+def sync_library_features(sp: spotipy.Spotify, user_id: str) -> Tuple[Dict, List[str], Optional[str]]:
+    """Return the feature cache, the user's liked track IDs and the library version.
+
+    The liked library is only re-downloaded when its version probe changes;
+    otherwise everything comes from the local files. If any feature batch
+    failed, no version is recorded, so the next visit syncs again and
+    retries the missing tracks. The returned version is None in that case,
+    and also when the listing itself failed part-way and the previously
+    saved library is returned instead.
+    """
+    lib = load_libraries().get(user_id)
+    version = get_liked_songs_version(sp)
+    if lib and lib.get('version') == version:
+        return load_feature_cache(), lib['tracks'], version
+
+    try:
+        songs = get_user_liked_songs(sp, strict=True)
+    except Exception as e:
+        if not lib:
+            raise
+        # Never record a truncated listing; fall back to the last complete one
+        print(f"Error listing liked songs, using the previous library: {e}")
+        return load_feature_cache(), lib['tracks'], None
+    tracks = [i['track'] for i in songs if i.get('track') and i['track'].get('id')]
+    cache, failed = ingest_audio_features(sp, tracks)
+    if failed:
+        version = None
+
+    track_ids = [tr['id'] for tr in tracks]
+    save_library(user_id, {'version': version, 'tracks': track_ids})
+    return cache, track_ids, version
+
+
+def library_matrix(cache: Dict, track_ids: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Cache row indices and feature rows for the library, skipping tracks without features"""
+    idx = np.fromiter((cache['index'][t] for t in dict.fromkeys(track_ids) if t in cache['index']), dtype=np.int64)
+    m = cache['matrix'][idx]
+    ok = ~np.isnan(m).any(axis=1)
+    return idx[ok], m[ok]
+
+
+def standardize(m: np.ndarray) -> np.ndarray:
+    std = m.std(axis=0)
+    std[std == 0] = 1.0
+    return (m - m.mean(axis=0)) / std
+
+
+def _columns(names: List[str]) -> List[int]:
+    return [FEATURES.index(n) for n in names]
+
+
+def feature_distributions(m: np.ndarray, bins: int = 10) -> Dict[str, Dict]:
+    dist = {}
+    for name in DISTRIBUTION_FEATURES:
+        col = m[:, FEATURES.index(name)]
+        if not len(col):
+            dist[name] = {'counts': [], 'edges': [], 'mean': None, 'median': None}
+            continue
+        rng = (float(col.min()), float(col.max())) if name == 'tempo' else (0.0, 1.0)
+        counts, edges = np.histogram(col, bins=bins, range=rng)
+        dist[name] = {
+            'counts': counts.tolist(),
+            'edges': [round(float(e), 2) for e in edges],
+            'mean': round(float(col.mean()), 2),
+            'median': round(float(np.median(col)), 2)
+        }
+    return dist
+
+
+def kmeans(x: np.ndarray, k: int, iters: int = 50, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Plain k-means with k-means++ seeding; returns (labels, centroids)"""
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    k = min(k, n)
+    centroids = np.empty((k, x.shape[1]), dtype=x.dtype)
+    centroids[0] = x[rng.integers(n)]
+    d2 = ((x - centroids[0]) ** 2).sum(axis=1)
+    for c in range(1, k):
+        total = d2.sum()
+        pick = rng.choice(n, p=d2 / total) if total > 0 else rng.integers(n)
+        centroids[c] = x[pick]
+        d2 = np.minimum(d2, ((x - centroids[c]) ** 2).sum(axis=1))
+
+    labels = np.zeros(n, dtype=np.int64)
+    for it in range(iters):
+        dist = ((x[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+        new_labels = dist.argmin(axis=1)
+        if it and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        counts = np.bincount(labels, minlength=k)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return labels, centroids
+
+
+def _mood_label(energy: float, valence: float) -> str:
+    if energy >= 0.5:
+        return 'Upbeat' if valence >= 0.5 else 'Intense'
+    return 'Chill' if valence >= 0.5 else 'Melancholic'
+
+
+def mood_clusters(cache: Dict, track_ids: List[str], k: int = 4) -> List[Dict]:
+    rows, m = library_matrix(cache, track_ids)
+    if not len(rows):
+        return []
+
+    mood = m[:, _columns(MOOD_FEATURES)]
+    labels, _ = kmeans(standardize(mood), k)
+
+    e, v, t = FEATURES.index('energy'), FEATURES.index('valence'), FEATURES.index('tempo')
+    clusters = []
+    for c in range(labels.max() + 1):
+        members = rows[labels == c]
+        if not len(members):
+            continue
+        centre = m[labels == c].mean(axis=0)
+        clusters.append({
+            'label': f"{_mood_label(centre[e], centre[v])} (~{int(round(centre[t]))} BPM)",
+            'energy': round(float(centre[e]), 2),
+            'valence': round(float(centre[v]), 2),
+            'tempo': round(float(centre[t]), 1),
+            'track_count': len(members),
+            'tracks': [_track_info(cache, r) for r in members]
+        })
+    clusters.sort(key=lambda x: x['track_count'], reverse=True)
+    return clusters
+
+
+def _track_info(cache: Dict, row: int) -> Dict[str, str]:
+    return {
+        'id': cache['ids'][row],
+        'name': cache['names'][row],
+        'artist': cache['artists'][row],
+        'uri': cache['uris'][row]
+    }
+
+
+def similar_tracks(cache: Dict, track_ids: List[str], track_id: str, n: int = 10) -> List[Dict]:
+    """Nearest neighbours of a track in standardized mood-feature space"""
+    rows, m = library_matrix(cache, track_ids)
+    if track_id not in cache['index']:
+        return []
+    target = cache['index'][track_id]
+    hit = np.flatnonzero(rows == target)
+    if not len(hit):
+        return []
+
+    x = standardize(m[:, _columns(MOOD_FEATURES)])
+    dist = ((x - x[hit[0]]) ** 2).sum(axis=1)
+    dist[hit[0]] = np.inf
+    n = min(n, len(dist) - 1)
+    if n <= 0:
+        return []
+    nearest = np.argpartition(dist, n - 1)[:n]
+    nearest = nearest[np.argsort(dist[nearest])]
+    return [dict(_track_info(cache, rows[i]), distance=round(float(np.sqrt(dist[i])), 3)) for i in nearest]
+
+
+def _analysis(user_id: str, cache: Dict, track_ids: List[str], version: Optional[str], k: int) -> Dict[str, any]:
+    """Distributions and clusters, memoized per process by library version, feature file and k"""
+    stamp = (version, cache['mtime'])
+    hit = _analysis_memo.get((user_id, k))
+    if version is not None and hit and hit[0] == stamp:
+        return hit[1]
+
+    _, m = library_matrix(cache, track_ids)
+    result = {
+        'track_count': len(track_ids),
+        'analysed_count': len(m),
+        'distributions': feature_distributions(m),
+        'clusters': mood_clusters(cache, track_ids, k)
+    }
+    if version is not None:
+        _analysis_memo[(user_id, k)] = (stamp, result)
+    return result
+
+
+def get_audio_analysis(sp: spotipy.Spotify, user_id: str, k: int = 4) -> Dict[str, any]:
+    cache, track_ids, version = sync_library_features(sp, user_id)
+    return _analysis(user_id, cache, track_ids, version, k)
+
+
+def get_similar_tracks(sp: spotipy.Spotify, user_id: str, track_id: str, n: int = 10) -> List[Dict]:
+    cache, track_ids, _ = sync_library_features(sp, user_id)
+    return similar_tracks(cache, track_ids, track_id, n)
+
+
+def create_mood_playlists(sp: spotipy.Spotify, k: int = 4) -> Dict[str, any]:
+    try:
+        usr = sp.current_user()
+        cache, track_ids, version = sync_library_features(sp, usr['id'])
+        clusters = _analysis(usr['id'], cache, track_ids, version, k)['clusters']
+
+        crt = []
+        for cl in clusters:
+            if cl['track_count'] < 5:
+                continue
+            name = f"Liked Songs - {cl['label']}"
+            desc = f"Auto-generated mood playlist (energy {cl['energy']}, valence {cl['valence']}) from liked songs"
+
+            pl = create_playlist(sp, usr['id'], name, desc)
+            if pl:
+                ok = add_tracks_to_playlist(sp, pl['id'], [t['uri'] for t in cl['tracks']])
+                if ok:
+                    crt.append({
+                        'name': name,
+                        'mood': cl['label'],
+                        'track_count': cl['track_count'],
+                        'playlist_id': pl['id']
+                    })
+
+        return {
+            'playlists_created': len(crt),
+            'playlists': crt,
+            'total_clusters': len(clusters)
+        }
+
+    except Exception as e:
+        print(f"Error creating mood playlists: {e}")
+        return {'playlists_created': 0, 'playlists': [], 'total_clusters': 0}
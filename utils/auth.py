@@ -3,6 +3,7 @@ from dotenv import load_dotenv
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from spotipy.oauth2 import SpotifyClientCredentials
+from spotipy.cache_handler import MemoryCacheHandler
 
 load_dotenv()
 
@@ -17,7 +18,9 @@ def get_spotify_oauth():
         client_id=SPOTIFY_CLIENT_ID,
         client_secret=SPOTIFY_CLIENT_SECRET,
         redirect_uri=REDIRECT_URI,
-        scope=scope
+        scope=scope,
+        # Tokens live in the server-side session store, not spotipy's shared .cache file
+        cache_handler=MemoryCacheHandler()
     )
 
 def get_spotify_client(token_info=None):
@@ -0,0 +1,62 @@
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Any, Callable, IO
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock; lock the first byte of the lock file instead
+    fcntl = None
+    import msvcrt
+
+
+def _lock(f: IO) -> None:
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        try:
+            # LK_LOCK retries for ~10s before raising; keep waiting like flock does
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            continue
+
+
+def _unlock(f: IO) -> None:
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(path: str):
+    """Exclusive lock on `path + '.lock'`, held across all worker processes"""
+    with open(path + '.lock', 'a+') as lock:
+        _lock(lock)
+        try:
+            yield
+        finally:
+            _unlock(lock)
+
+
+def atomic_write(path: str, write: Callable[[IO[bytes]], None]) -> None:
+    """Write through a private temp file in the same directory, then rename over `path`"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def atomic_write_json(path: str, data: Any) -> None:
+    atomic_write(path, lambda f: f.write(json.dumps(data, ensure_ascii=False).encode('utf-8')))
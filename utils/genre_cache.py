@@ -1,91 +1,275 @@
 import json
 import os
-from typing import List, Dict, Optional
+import sqlite3
+import time
+from typing import List, Dict, Iterable, Optional, Set
 import spotipy
 
+# Seed file from earlier versions; imported into the artists table on first use
 CACHE_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'genre_cache.json')
+TRACK_GENRE_FILE = os.getenv('TRACK_GENRE_FILE', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'track_genres.db'))
+
+# sp.artists accepts at most 50 IDs per call
+ARTIST_BATCH_SIZE = 50
+# Artist genres older than this are re-fetched, at most one batch per update
+ARTIST_GENRE_TTL = 30 * 24 * 3600
+# Stay well below SQLite's bound-parameter limit
+SQL_CHUNK = 500
+
+_schema_ready = False
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    conn = sqlite3.connect(TRACK_GENRE_FILE, timeout=10)
+    if not _schema_ready:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS artists (artist_id TEXT PRIMARY KEY, genres TEXT NOT NULL, fetched_at INTEGER NOT NULL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS tracks (track_id TEXT PRIMARY KEY, artists TEXT NOT NULL, genres TEXT NOT NULL)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS track_artists ('
+            ' artist_id TEXT NOT NULL, track_id TEXT NOT NULL,'
+            ' PRIMARY KEY (artist_id, track_id)) WITHOUT ROWID'
+        )
+        if not conn.execute('SELECT 1 FROM artists LIMIT 1').fetchone():
+            _import_json_cache(conn)
+        conn.commit()
+        _schema_ready = True
+    return conn
+
+def _import_json_cache(conn: sqlite3.Connection) -> None:
+    """Seed the artists table from genre_cache.json; imported artists start their TTL now"""
+    if not os.path.exists(CACHE_FILE):
+        return
+    try:
+        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+            legacy = json.load(f)
+    except (json.JSONDecodeError, FileNotFoundError):
+        print("Error loading genre cache, starting with empty cache")
+        return
+    _store_artists(conn, legacy, replace=False)
+    print(f"Imported {len(legacy)} artists from {CACHE_FILE}")
+
+def _store_artists(conn: sqlite3.Connection, artists: Dict[str, List[str]], replace: bool = True) -> None:
+    now = int(time.time())
+    conn.executemany(
+        f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO artists (artist_id, genres, fetched_at) VALUES (?, ?, ?)",
+        [(a, json.dumps(g, ensure_ascii=False), now) for a, g in artists.items()]
+    )
 
 def load_genre_cache() -> Dict[str, List[str]]:
-    if os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            print("Error loading genre cache, starting with empty cache")
-            return {}
-    return {}
+    conn = _connect()
+    try:
+        return {a: json.loads(g) for a, g in conn.execute('SELECT artist_id, genres FROM artists')}
+    finally:
+        conn.close()
 
 def save_genre_cache(cache: Dict[str, List[str]]) -> None:
+    """Upsert the given artists; each is its own row, so concurrent workers never drop each other's"""
+    conn = _connect()
     try:
-        dir_path = os.path.dirname(CACHE_FILE)
-        if dir_path and not os.path.exists(dir_path):
-            os.makedirs(dir_path, exist_ok=True)
-            
-        with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, indent=2, ensure_ascii=False)
-        print(f"Genre cache saved to {CACHE_FILE} with {len(cache)} artists")
-    except Exception as e:
+        _store_artists(conn, cache)
+        conn.commit()
+    except sqlite3.Error as e:
         print(f"Error saving genre cache: {e}")
+    finally:
+        conn.close()
 
 def get_cache_stats() -> Dict[str, int]:
-    cache = load_genre_cache()
-    total = len(cache)
-    with_genres = len([artist for artist, genres in cache.items() if genres])
-    
+    conn = _connect()
+    try:
+        total, without = conn.execute("SELECT COUNT(*), COALESCE(SUM(genres = '[]'), 0) FROM artists").fetchone()
+    finally:
+        conn.close()
+
     return {
         'total_artists': total,
-        'artists_with_genres': with_genres,
-        'artists_without_genres': total - with_genres
+        'artists_with_genres': total - without,
+        'artists_without_genres': without
     }
 
 def get_artist_genres(sp: spotipy.Spotify, artist_id: str, cache: Dict[str, List[str]]) -> List[str]:
     if artist_id in cache:
         print(f"Using cached genres for artist {artist_id}")
         return cache[artist_id]
-    
+
     try:
         info = sp.artist(artist_id)
         genres = info.get('genres', [])
-        
+
         cache[artist_id] = genres
-        save_genre_cache(cache)
+        save_genre_cache({artist_id: genres})
         print(f"Fetched and cached genres for artist {artist_id}: {genres}")
-        
+
         return genres
     except Exception as e:
         print(f"Error getting genres for artist {artist_id}: {e}")
         cache[artist_id] = []
-        save_genre_cache(cache)
+        save_genre_cache({artist_id: []})
+        return []
+
+def _chunks(items: List[str]) -> Iterable[List[str]]:
+    for i in range(0, len(items), SQL_CHUNK):
+        yield items[i:i + SQL_CHUNK]
+
+def _in(chunk: List[str]) -> str:
+    return ','.join('?' * len(chunk))
+
+def _union_genres(artist_ids: List[str], cache: Dict[str, List[str]]) -> List[str]:
+    # Primary artist's genres first, then any the other credited artists add
+    return list(dict.fromkeys(g for a in artist_ids for g in cache.get(a, [])))
+
+def _actual_track(item: Dict) -> Optional[Dict]:
+    return item.get('track') if 'track' in item else item
+
+def _load_artists(conn: sqlite3.Connection, artist_ids: List[str]) -> Dict[str, List[str]]:
+    found = {}
+    for chunk in _chunks(artist_ids):
+        rows = conn.execute(f"SELECT artist_id, genres FROM artists WHERE artist_id IN ({_in(chunk)})", chunk)
+        found.update((a, json.loads(g)) for a, g in rows)
+    return found
+
+def _select_tracks(conn: sqlite3.Connection, track_ids: List[str]) -> Dict[str, Dict]:
+    found = {}
+    for chunk in _chunks(track_ids):
+        rows = conn.execute(f"SELECT track_id, artists, genres FROM tracks WHERE track_id IN ({_in(chunk)})", chunk)
+        for track_id, artists, genres in rows:
+            found[track_id] = {'artists': json.loads(artists), 'genres': json.loads(genres)}
+    return found
+
+def _write_tracks(conn: sqlite3.Connection, tracks: Dict[str, List[str]], cache: Dict[str, List[str]]) -> None:
+    """Insert or replace only the given rows"""
+    conn.executemany(
+        'INSERT OR REPLACE INTO tracks (track_id, artists, genres) VALUES (?, ?, ?)',
+        [(t, json.dumps(a), json.dumps(_union_genres(a, cache), ensure_ascii=False)) for t, a in tracks.items()]
+    )
+    conn.executemany('DELETE FROM track_artists WHERE track_id = ?', [(t,) for t in tracks])
+    conn.executemany(
+        'INSERT OR IGNORE INTO track_artists (artist_id, track_id) VALUES (?, ?)',
+        [(a, t) for t, ids in tracks.items() for a in ids]
+    )
+
+def _fetch_artists(sp: spotipy.Spotify, conn: sqlite3.Connection, artist_ids: List[str], cache: Dict[str, List[str]]) -> Set[str]:
+    """Fetch artists 50 per request into the table and `cache`; returns IDs whose genres are new or changed"""
+    changed = set()
+    for i in range(0, len(artist_ids), ARTIST_BATCH_SIZE):
+        batch = artist_ids[i:i + ARTIST_BATCH_SIZE]
+        try:
+            res = sp.artists(batch).get('artists', [])
+        except Exception as e:
+            print(f"Error fetching genres for artist batch at {i}: {e}")
+            continue
+        fetched = {a: (info or {}).get('genres', []) for a, info in zip(batch, res)}
+        changed.update(a for a, g in fetched.items() if cache.get(a) != g)
+        cache.update(fetched)
+        # Rewrite every fetched row, unchanged ones too, to restart their TTL
+        _store_artists(conn, fetched)
+    if changed:
+        print(f"Fetched and cached genres for {len(changed)} artists")
+    return changed
+
+def _stale_artists(conn: sqlite3.Connection, artist_ids: List[str]) -> List[str]:
+    """Up to one batch of these artists whose genres are older than ARTIST_GENRE_TTL, oldest first"""
+    cutoff = int(time.time()) - ARTIST_GENRE_TTL
+    stale = []
+    for chunk in _chunks(artist_ids):
+        rows = conn.execute(
+            f"SELECT artist_id FROM artists WHERE fetched_at < ? AND artist_id IN ({_in(chunk)})"
+            f" ORDER BY fetched_at LIMIT {ARTIST_BATCH_SIZE - len(stale)}",
+            [cutoff] + chunk
+        )
+        stale.extend(r[0] for r in rows)
+        if len(stale) >= ARTIST_BATCH_SIZE:
+            break
+    return stale
+
+def _remap_artists(conn: sqlite3.Connection, artist_ids: Iterable[str], cache: Dict[str, List[str]]) -> None:
+    """Recompute every mapped track that credits one of these artists"""
+    track_ids = set()
+    for chunk in _chunks(list(artist_ids)):
+        rows = conn.execute(f"SELECT track_id FROM track_artists WHERE artist_id IN ({_in(chunk)})", chunk)
+        track_ids.update(r[0] for r in rows)
+    if not track_ids:
+        return
+    existing = _select_tracks(conn, list(track_ids))
+    needed = [a for e in existing.values() for a in e['artists'] if a not in cache]
+    cache.update(_load_artists(conn, list(dict.fromkeys(needed))))
+    _write_tracks(conn, {t: e['artists'] for t, e in existing.items()}, cache)
+
+def update_track_genre_map(sp: spotipy.Spotify, tracks: List[Dict], cache: Dict[str, List[str]] = None) -> Dict[str, Dict]:
+    """Return {track_id: {'artists': [...], 'genres': [...]}} for the given tracks.
+
+    Accepts saved/playlist items or bare track objects. Only the credited
+    artists' rows are read; unknown artists are fetched in one batched pass,
+    and at most one batch of artists past ARTIST_GENRE_TTL is re-fetched.
+    Only new tracks, tracks whose credited artists changed and tracks
+    crediting an artist whose genres changed are written, so a warm map
+    does no writes at all. `cache`, if given, is filled with the genres of
+    every credited artist.
+    """
+    cache = {} if cache is None else cache
+
+    wanted = {}
+    for item in tracks:
+        tr = _actual_track(item)
+        if not tr or not tr.get('id') or not tr.get('artists'):
+            continue
+        wanted[tr['id']] = [a['id'] for a in tr['artists'] if a.get('id')]
+    if not wanted:
+        return {}
+
+    conn = _connect()
+    try:
+        existing = _select_tracks(conn, list(wanted))
+        pending = {t: a for t, a in wanted.items() if t not in existing or existing[t]['artists'] != a}
+
+        artist_ids = list(dict.fromkeys(a for ids in wanted.values() for a in ids))
+        cache.update(_load_artists(conn, [a for a in artist_ids if a not in cache]))
+        _fetch_artists(sp, conn, [a for a in artist_ids if a not in cache], cache)
+        changed = _fetch_artists(sp, conn, _stale_artists(conn, artist_ids), cache)
+
+        # Leave tracks with unfetched artists unmapped so they are retried next time
+        ready = {t: a for t, a in pending.items() if all(x in cache for x in a)}
+        if ready:
+            _write_tracks(conn, ready, cache)
+        if changed:
+            _remap_artists(conn, changed, cache)
+        conn.commit()
+
+        if not ready and not changed:
+            return existing
+        return _select_tracks(conn, list(wanted))
+    finally:
+        conn.close()
+
+def get_track_genres(track_map: Dict[str, Dict], item: Dict) -> List[str]:
+    tr = _actual_track(item)
+    if not tr or not tr.get('id'):
         return []
+    entry = track_map.get(tr['id'])
+    return entry['genres'] if entry else []
 
 def enrich_tracks_with_cached_genres(sp: spotipy.Spotify, tracks: List[Dict]) -> List[Dict]:
-    cache = load_genre_cache()
-    
+    """Return copies of the items with `genres` on each artist and their union on the track.
+
+    Saved/playlist items and bare tracks are treated alike: the item and its
+    track dict are copied, and the input list is left untouched.
+    """
+    cache = {}
+    track_map = update_track_genre_map(sp, tracks, cache)
+
     enriched = []
-    
+
     for item in tracks:
-        track = item.copy()
-        
-        actual = track.get('track') if 'track' in track else track
-        
+        nested = 'track' in item
+        actual = item.get('track') if nested else item
+
         if actual and actual.get('artists'):
-            try:
-                artist_id = actual['artists'][0]['id']
-                genres = get_artist_genres(sp, artist_id, cache)
-                
-                if 'track' in track:
-                    track['track']['artists'][0]['genres'] = genres
-                else:
-                    track['artists'][0]['genres'] = genres
-                    
-            except Exception as e:
-                print(f"Error processing genres for track: {e}")
-                if 'track' in track:
-                    track['track']['artists'][0]['genres'] = []
-                else:
-                    track['artists'][0]['genres'] = []
-        
-        enriched.append(track)
-    
-    print(f"Genre cache now contains {len(cache)} artists")
+            actual = dict(actual, artists=[dict(a, genres=cache.get(a.get('id'), [])) for a in actual['artists']])
+            actual['genres'] = get_track_genres(track_map, actual)
+        elif actual:
+            actual = dict(actual)
+
+        enriched.append(dict(item, track=actual) if nested else actual)
+
+    print(f"Enriched {len(enriched)} tracks with genres from {len(cache)} artists")
     return enriched
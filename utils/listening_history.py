@@ -0,0 +1,191 @@
+import datetime
+import os
+import sqlite3
+from collections import Counter
+from typing import List, Dict, Optional
+import spotipy
+
+from .file_store import file_lock
+from .genre_cache import update_track_genre_map, get_track_genres
+
+HISTORY_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'history')
+
+# recently-played never returns more than 50 items per page
+PAGE_SIZE = 50
+MAX_PAGES = 20
+
+_schema_ready = set()
+
+
+def _user_dir(user_id: str) -> str:
+    return os.path.join(HISTORY_DIR, user_id)
+
+
+def _connect(user_id: str) -> sqlite3.Connection:
+    """Per-user rollup store: one row per (bucket, kind, key) count"""
+    os.makedirs(_user_dir(user_id), exist_ok=True)
+    path = os.path.join(_user_dir(user_id), 'rollups.db')
+    conn = sqlite3.connect(path, timeout=10)
+    if path not in _schema_ready:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE IF NOT EXISTS buckets (bucket TEXT PRIMARY KEY, plays INTEGER NOT NULL)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS counts ('
+            ' bucket TEXT NOT NULL, kind TEXT NOT NULL, key TEXT NOT NULL, count INTEGER NOT NULL,'
+            ' PRIMARY KEY (bucket, kind, key)) WITHOUT ROWID'
+        )
+        # Top-N per bucket is a short walk down this index
+        conn.execute('CREATE INDEX IF NOT EXISTS counts_top ON counts (bucket, kind, count)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS names ('
+            ' kind TEXT NOT NULL, id TEXT NOT NULL, name TEXT NOT NULL,'
+            ' PRIMARY KEY (kind, id)) WITHOUT ROWID'
+        )
+        conn.commit()
+        _schema_ready.add(path)
+    return conn
+
+
+def _meta(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+    return row[0] if row else None
+
+
+def _played_at(item: Dict) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(item['played_at'].replace('Z', '+00:00'))
+
+
+def _fetch_new_plays(sp: spotipy.Spotify, cursor: Optional[int]) -> List[Dict]:
+    """Plays strictly after the cursor (unix ms), oldest first"""
+    plays = {}
+    after = cursor
+    for _ in range(MAX_PAGES):
+        res = sp.current_user_recently_played(limit=PAGE_SIZE, after=after)
+        items = [i for i in (res or {}).get('items', []) if i.get('track') and i['track'].get('id')]
+        fresh = 0
+        for item in items:
+            ms = int(_played_at(item).timestamp() * 1000)
+            if (cursor is None or ms > cursor) and ms not in plays:
+                item['played_ms'] = ms
+                plays[ms] = item
+                fresh += 1
+        if not fresh or not res.get('next') or len(res.get('items', [])) < PAGE_SIZE:
+            break
+        after = max(plays)
+    return [plays[ms] for ms in sorted(plays)]
+
+
+def ingest_recent_plays(sp: spotipy.Spotify, user_id: str) -> int:
+    """Append new plays to the monthly logs and fold them into the rollups.
+
+    The `after` cursor is the newest play already stored, so every play is
+    downloaded and counted exactly once. Counts are kept per bucket
+    ('all', 'YYYY' and 'YYYY-MM', in UTC) as SQLite rows, so an ingest only
+    touches the rows its plays increment. The whole read-fetch-write runs
+    under a per-user lock, and the logs are only appended once the counts
+    (and cursor) are committed, so concurrent requests or a failed commit
+    never log a play twice.
+    """
+    os.makedirs(_user_dir(user_id), exist_ok=True)
+    with file_lock(os.path.join(_user_dir(user_id), 'history')):
+        return _ingest(sp, user_id)
+
+
+def _ingest(sp: spotipy.Spotify, user_id: str) -> int:
+    conn = _connect(user_id)
+    try:
+        cursor = _meta(conn, 'cursor')
+        plays = _fetch_new_plays(sp, int(cursor) if cursor else None)
+        if not plays:
+            return 0
+
+        tmap = update_track_genre_map(sp, plays)
+
+        logs = {}
+        counts = Counter()
+        bucket_plays = Counter()
+        names = {}
+        for item in plays:
+            tr = item['track']
+            month = _played_at(item).strftime('%Y-%m')
+            logs.setdefault(month, []).append(f"{item['played_ms']}\t{tr['id']}\n")
+
+            genres = get_track_genres(tmap, tr)
+            names[('tracks', tr['id'])] = tr.get('name') or ''
+            for a in tr.get('artists', []):
+                names[('artists', a['id'])] = a.get('name') or ''
+            for key in ('all', month[:4], month):
+                bucket_plays[key] += 1
+                counts[(key, 'tracks', tr['id'])] += 1
+                for a in tr.get('artists', []):
+                    counts[(key, 'artists', a['id'])] += 1
+                for g in genres:
+                    counts[(key, 'genres', g)] += 1
+
+        try:
+            conn.executemany(
+                'INSERT INTO buckets (bucket, plays) VALUES (?, ?)'
+                ' ON CONFLICT (bucket) DO UPDATE SET plays = plays + excluded.plays',
+                list(bucket_plays.items())
+            )
+            conn.executemany(
+                'INSERT INTO counts (bucket, kind, key, count) VALUES (?, ?, ?, ?)'
+                ' ON CONFLICT (bucket, kind, key) DO UPDATE SET count = count + excluded.count',
+                [(b, k, key, c) for (b, k, key), c in counts.items()]
+            )
+            conn.executemany(
+                'INSERT OR REPLACE INTO names (kind, id, name) VALUES (?, ?, ?)',
+                [(k, i, n) for (k, i), n in names.items()]
+            )
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('cursor', ?)", (str(plays[-1]['played_ms']),))
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('first_play', ?)", (plays[0]['played_at'],))
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Error saving listening history rollups: {e}")
+            conn.rollback()
+            return 0
+    finally:
+        conn.close()
+
+    for month, lines in logs.items():
+        with open(os.path.join(_user_dir(user_id), f"{month}.tsv"), 'a', encoding='utf-8') as f:
+            f.writelines(lines)
+    print(f"Ingested {len(plays)} new plays into listening history")
+    return len(plays)
+
+
+def period_key(p: str, now: datetime.datetime = None) -> str:
+    """Map a period name ('all', 'year', 'month', 'YYYY', 'YYYY-MM') to its bucket"""
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    if p == 'year':
+        return now.strftime('%Y')
+    if p == 'month':
+        return now.strftime('%Y-%m')
+    return p or 'all'
+
+
+def get_listening_stats(user_id: str, p: str = 'all', n: int = 10) -> Dict[str, any]:
+    """Top-n lists for one bucket, read straight off the counts index"""
+    key = period_key(p)
+    conn = _connect(user_id)
+    try:
+        def top(kind):
+            return conn.execute(
+                'SELECT COALESCE(n.name, c.key), c.count FROM counts c'
+                ' LEFT JOIN names n ON n.kind = c.kind AND n.id = c.key'
+                ' WHERE c.bucket = ? AND c.kind = ? ORDER BY c.count DESC LIMIT ?',
+                (key, kind, n)
+            ).fetchall()
+
+        plays = conn.execute('SELECT plays FROM buckets WHERE bucket = ?', (key,)).fetchone()
+        return {
+            'top_artists': top('artists'),
+            'top_genres': top('genres'),
+            'top_tracks': top('tracks'),
+            'total_plays': plays[0] if plays else 0,
+            'first_play': _meta(conn, 'first_play'),
+            'periods': [r[0] for r in conn.execute("SELECT bucket FROM buckets WHERE bucket != 'all' ORDER BY bucket DESC")]
+        }
+    finally:
+        conn.close()
@@ -0,0 +1,126 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CACHE_FILE = os.getenv('RESPONSE_CACHE_FILE', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'response_cache.db'))
+
+# Versions are part of the key, so entries never go stale; the TTL only bounds disk use
+CACHE_TTL = 7 * 24 * 3600
+# Bodies smaller than this are not worth compressing
+MIN_COMPRESS_SIZE = 1024
+
+_schema_ready = False
+
+
+def _render_version() -> str:
+    """Digest of the templates and Python sources, so a deploy that changes either starts a fresh cache"""
+    root = os.path.dirname(os.path.dirname(__file__))
+    digest = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(root, 'templates', '*.html')) + glob.glob(os.path.join(root, '*.py'))
+                       + glob.glob(os.path.join(root, 'utils', '*.py'))):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+RENDER_VERSION = os.getenv('RENDER_VERSION') or _render_version()
+
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    conn = sqlite3.connect(CACHE_FILE, timeout=10, isolation_level=None)
+    if not _schema_ready:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' key TEXT PRIMARY KEY,'
+            ' mimetype TEXT NOT NULL,'
+            ' gzip BLOB NOT NULL,'
+            ' br BLOB,'
+            ' created_at INTEGER NOT NULL)'
+        )
+        _schema_ready = True
+    return conn
+
+
+def make_cache_key(*parts) -> str:
+    """Hash of the render version, page name, user, library version and filter args; doubles as the ETag"""
+    raw = json.dumps((RENDER_VERSION,) + parts, sort_keys=True, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+
+def pick_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = set()
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            k, _, v = param.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        # q=0 means "not acceptable"
+        if q > 0:
+            accepted.add(name.strip().lower())
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def get_cached(key: str) -> Optional[Dict]:
+    conn = _connect()
+    try:
+        row = conn.execute('SELECT mimetype, gzip, br FROM responses WHERE key = ?', (key,)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    return {'mimetype': row[0], 'gzip': row[1], 'br': row[2]}
+
+
+def put_cached(key: str, body: bytes, mimetype: str) -> Dict:
+    """Store the body pre-compressed so cache hits never pay for compression"""
+    entry = {
+        'mimetype': mimetype,
+        'gzip': compress(body, 'gzip'),
+        'br': compress(body, 'br') if brotli is not None else None
+    }
+    now = int(time.time())
+    conn = _connect()
+    try:
+        conn.execute('DELETE FROM responses WHERE created_at < ?', (now - CACHE_TTL,))
+        conn.execute(
+            'INSERT OR REPLACE INTO responses (key, mimetype, gzip, br, created_at) VALUES (?, ?, ?, ?, ?)',
+            (key, mimetype, entry['gzip'], entry['br'], now)
+        )
+    except sqlite3.Error as e:
+        print(f"Error saving response cache entry: {e}")
+    finally:
+        conn.close()
+    return entry
+
+
+def encoded_body(entry: Dict, encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    if encoding and entry.get(encoding) is not None:
+        return entry[encoding], encoding
+    return gzip.decompress(entry['gzip']), None
@@ -0,0 +1,130 @@
+import json
+import os
+import secrets
+import sqlite3
+import time
+from typing import Dict, Optional
+
+from spotipy.oauth2 import SpotifyOauthError
+
+from .auth import get_spotify_oauth
+
+STORE_FILE = os.getenv('SESSION_STORE_FILE', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'session_store.db'))
+
+# Refresh this many seconds before Spotify's expiry so requests never see a dead token
+REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', '300'))
+# How long one worker may hold the refresh lease before another is allowed to retry
+REFRESH_LEASE = 30
+# Sessions untouched for this long are purged on the next login
+SESSION_MAX_AGE = 30 * 24 * 3600
+
+_schema_ready = False
+
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    conn = sqlite3.connect(STORE_FILE, timeout=10, isolation_level=None)
+    if not _schema_ready:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS sessions ('
+            ' sid TEXT PRIMARY KEY,'
+            ' token_info TEXT NOT NULL,'
+            ' expires_at INTEGER NOT NULL,'
+            ' refresh_lease INTEGER NOT NULL DEFAULT 0,'
+            ' updated_at INTEGER NOT NULL)'
+        )
+        _schema_ready = True
+    return conn
+
+
+def create_session(token_info: Dict) -> str:
+    sid = secrets.token_urlsafe(32)
+    now = int(time.time())
+    conn = _connect()
+    try:
+        conn.execute('DELETE FROM sessions WHERE updated_at < ?', (now - SESSION_MAX_AGE,))
+        conn.execute(
+            'INSERT INTO sessions (sid, token_info, expires_at, updated_at) VALUES (?, ?, ?, ?)',
+            (sid, json.dumps(token_info), int(token_info.get('expires_at', 0)), now)
+        )
+    finally:
+        conn.close()
+    return sid
+
+
+def delete_session(sid: str) -> None:
+    conn = _connect()
+    try:
+        conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+    finally:
+        conn.close()
+
+
+def _read(conn: sqlite3.Connection, sid: str) -> Optional[Dict]:
+    row = conn.execute('SELECT token_info FROM sessions WHERE sid = ?', (sid,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def get_session_token(sid: str) -> Optional[Dict]:
+    """Return a usable token for the session, refreshing it ahead of expiry.
+
+    Only one worker refreshes a given session at a time: the refresh lease is
+    taken with a conditional UPDATE, so concurrent requests in other gunicorn
+    workers keep using the still-valid token (or wait for the new one if it
+    has already expired) instead of all hitting the token endpoint.
+    """
+    conn = _connect()
+    try:
+        token_info = _read(conn, sid)
+        if not token_info:
+            return None
+
+        now = int(time.time())
+        if token_info.get('expires_at', 0) - now > REFRESH_MARGIN:
+            return token_info
+
+        got_lease = conn.execute(
+            'UPDATE sessions SET refresh_lease = ? WHERE sid = ? AND refresh_lease < ?',
+            (now + REFRESH_LEASE, sid, now)
+        ).rowcount == 1
+
+        if got_lease:
+            return _refresh(conn, sid, token_info)
+
+        if token_info.get('expires_at', 0) > now:
+            return token_info
+
+        # Token already expired and another worker is refreshing it
+        deadline = time.time() + REFRESH_LEASE
+        while time.time() < deadline:
+            time.sleep(0.2)
+            token_info = _read(conn, sid)
+            if not token_info:
+                return None
+            if token_info.get('expires_at', 0) > time.time():
+                return token_info
+        return None
+    finally:
+        conn.close()
+
+
+def _refresh(conn: sqlite3.Connection, sid: str, token_info: Dict) -> Optional[Dict]:
+    try:
+        new_info = get_spotify_oauth().refresh_access_token(token_info['refresh_token'])
+    except Exception as e:
+        print(f"Error refreshing token for session: {e}")
+        if isinstance(e, SpotifyOauthError) and e.error == 'invalid_grant':
+            # Refresh token revoked or expired: only a new login can fix this
+            conn.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+            return None
+        # Transient failure (network, 5xx): keep the session so the next request retries
+        conn.execute('UPDATE sessions SET refresh_lease = 0 WHERE sid = ?', (sid,))
+        return token_info if token_info.get('expires_at', 0) > time.time() else None
+
+    conn.execute(
+        'UPDATE sessions SET token_info = ?, expires_at = ?, refresh_lease = 0, updated_at = ? WHERE sid = ?',
+        (json.dumps(new_info), int(new_info.get('expires_at', 0)), int(time.time()), sid)
+    )
+    print("Refreshed access token for session")
+    return new_info
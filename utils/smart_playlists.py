@@ -0,0 +1,426 @@
+import datetime
+import json
+import os
+import sqlite3
+import uuid
+from typing import Callable, Iterable, List, Dict, Optional, Tuple
+import spotipy
+
+from .file_store import file_lock
+from .genre_cache import update_track_genre_map, get_track_genres
+from .spotify_api import get_user_liked_songs, get_liked_songs_since, create_playlist
+
+RULES_FILE = os.getenv('SMART_PLAYLISTS_FILE', os.path.join(os.path.dirname(os.path.dirname(__file__)), 'smart_playlists.db'))
+
+RULE_FIELDS = ('genres', 'artists', 'year_min', 'year_max', 'popularity_min', 'explicit', 'added_within_days')
+
+# Spotify's limit for playlist add/remove requests
+BATCH_SIZE = 100
+# Stay well below SQLite's bound-parameter limit
+SQL_CHUNK = 500
+
+_schema_ready = False
+
+
+def _connect() -> sqlite3.Connection:
+    global _schema_ready
+    conn = sqlite3.connect(RULES_FILE, timeout=10)
+    if not _schema_ready:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            ' user_id TEXT PRIMARY KEY,'
+            ' cursor TEXT,'
+            ' cursor_ids TEXT NOT NULL,'
+            ' total INTEGER NOT NULL)'
+        )
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS rules ('
+            ' rule_id TEXT PRIMARY KEY,'
+            ' user_id TEXT NOT NULL,'
+            ' name TEXT NOT NULL,'
+            ' rule TEXT NOT NULL,'
+            ' playlist_id TEXT NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS rules_user ON rules (user_id)')
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS members ('
+            ' rule_id TEXT NOT NULL, track_id TEXT NOT NULL, added_at TEXT NOT NULL,'
+            ' PRIMARY KEY (rule_id, track_id)) WITHOUT ROWID'
+        )
+        # Window rules expire members from the old end of this index
+        conn.execute('CREATE INDEX IF NOT EXISTS members_added ON members (rule_id, added_at)')
+        # Add/remove batches Spotify has not accepted yet; the latest intent per track wins
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS pending ('
+            ' rule_id TEXT NOT NULL, track_id TEXT NOT NULL, action TEXT NOT NULL, added_at TEXT NOT NULL,'
+            ' PRIMARY KEY (rule_id, track_id)) WITHOUT ROWID'
+        )
+        conn.commit()
+        _schema_ready = True
+    return conn
+
+
+def _user_lock(user_id: str) -> str:
+    """Lock path for one user's rules, so users never wait on each other"""
+    return f"{RULES_FILE}.{user_id}"
+
+
+def _chunks(items: List[str]) -> Iterable[List[str]]:
+    for i in range(0, len(items), SQL_CHUNK):
+        yield items[i:i + SQL_CHUNK]
+
+
+def _load_user(conn: sqlite3.Connection, user_id: str) -> Optional[Dict]:
+    row = conn.execute('SELECT cursor, cursor_ids, total FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    if not row:
+        return None
+    return {'cursor': row[0], 'cursor_ids': json.loads(row[1]), 'total': row[2]}
+
+
+def _save_user(conn: sqlite3.Connection, user_id: str, state: Dict) -> None:
+    conn.execute(
+        'INSERT OR REPLACE INTO users (user_id, cursor, cursor_ids, total) VALUES (?, ?, ?, ?)',
+        (user_id, state['cursor'], json.dumps(state['cursor_ids']), state['total'])
+    )
+
+
+def _load_rules(conn: sqlite3.Connection, user_id: str) -> Dict[str, Dict]:
+    rows = conn.execute('SELECT rule_id, name, rule, playlist_id FROM rules WHERE user_id = ?', (user_id,))
+    return {rid: {'name': name, 'rule': json.loads(rule), 'playlist_id': pid} for rid, name, rule, pid in rows}
+
+
+def _list(value) -> List[str]:
+    if isinstance(value, str):
+        value = value.split(',')
+    return [v.strip().lower() for v in (value or []) if v and v.strip()]
+
+
+def _int(value) -> Optional[int]:
+    if value in (None, ''):
+        return None
+    return int(value)
+
+
+def parse_rule(data: Dict) -> Dict:
+    """Normalize rule fields from a request; raises ValueError on bad input"""
+    explicit = data.get('explicit')
+    if isinstance(explicit, str):
+        explicit = {'true': True, 'false': False, '': None}.get(explicit.lower(), 'invalid')
+    if explicit not in (True, False, None):
+        raise ValueError('explicit must be true, false or empty')
+
+    rule = {
+        'genres': _list(data.get('genres')),
+        'artists': _list(data.get('artists')),
+        'year_min': _int(data.get('year_min')),
+        'year_max': _int(data.get('year_max')),
+        'popularity_min': _int(data.get('popularity_min')),
+        'explicit': explicit,
+        'added_within_days': _int(data.get('added_within_days'))
+    }
+    if not any(rule[f] not in (None, []) for f in RULE_FIELDS):
+        raise ValueError('A smart playlist needs at least one condition')
+    return rule
+
+
+def compile_rule(rule: Dict, now: datetime.datetime = None) -> Callable[[Dict, List[str]], bool]:
+    """Turn a rule into a predicate over (saved/playlist track item, genres).
+
+    Only the conditions the rule actually sets become checks, cheapest first,
+    and genres are consulted last so they are only looked at for tracks that
+    pass everything else.
+    """
+    checks = []
+
+    if rule.get('explicit') is not None:
+        want = rule['explicit']
+        checks.append(lambda item, tr: bool(tr.get('explicit', False)) == want)
+
+    if rule.get('popularity_min') is not None:
+        pop = rule['popularity_min']
+        checks.append(lambda item, tr: tr.get('popularity', 0) >= pop)
+
+    if rule.get('year_min') is not None or rule.get('year_max') is not None:
+        lo = rule.get('year_min') or 0
+        hi = rule.get('year_max') or 9999
+
+        def year_ok(item, tr):
+            y = tr.get('album', {}).get('release_date', '')[:4]
+            return y.isdigit() and lo <= int(y) <= hi
+        checks.append(year_ok)
+
+    if rule.get('added_within_days') is not None:
+        cutoff = _cutoff(rule['added_within_days'], now)
+        checks.append(lambda item, tr: (item.get('added_at') or '') >= cutoff)
+
+    if rule.get('artists'):
+        wanted = set(rule['artists'])
+        checks.append(lambda item, tr: any(
+            a.get('id', '').lower() in wanted or (a.get('name') or '').lower() in wanted
+            for a in tr.get('artists', [])
+        ))
+
+    wanted_genres = rule.get('genres') or []
+
+    def predicate(item: Dict, genres: List[str]) -> bool:
+        tr = item.get('track')
+        if not tr:
+            return False
+        for check in checks:
+            if not check(item, tr):
+                return False
+        if wanted_genres:
+            return any(w in g.lower() for g in genres for w in wanted_genres)
+        return True
+
+    return predicate
+
+
+def _cutoff(days: int, now: datetime.datetime = None) -> str:
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return (now - datetime.timedelta(days=days)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _match(sp: spotipy.Spotify, items: List[Dict], rules: Dict[str, Dict], now: datetime.datetime) -> Dict[str, Dict[str, str]]:
+    """Matching {track_id: added_at} per rule for the given items"""
+    items = [i for i in items if i.get('track') and i['track'].get('id')]
+    tmap = update_track_genre_map(sp, items) if any(r['rule'].get('genres') for r in rules.values()) else {}
+
+    preds = {rid: compile_rule(r['rule'], now) for rid, r in rules.items()}
+    matches = {rid: {} for rid in rules}
+    for item in items:
+        genres = get_track_genres(tmap, item)
+        for rid, pred in preds.items():
+            if pred(item, genres):
+                matches[rid][item['track']['id']] = item.get('added_at') or ''
+    return matches
+
+
+def _cursor(items: List[Dict]) -> Tuple[str, List[str]]:
+    if not items:
+        return '', []
+    newest = items[0].get('added_at') or ''
+    ids = [i['track']['id'] for i in items if i.get('added_at') == newest and i.get('track') and i['track'].get('id')]
+    return newest, ids
+
+
+def _is_window(entry: Dict) -> bool:
+    return entry['rule'].get('added_within_days') is not None
+
+
+def _members_among(conn: sqlite3.Connection, rid: str, track_ids: List[str]) -> set:
+    found = set()
+    for chunk in _chunks(track_ids):
+        rows = conn.execute(
+            f"SELECT track_id FROM members WHERE rule_id = ? AND track_id IN ({','.join('?' * len(chunk))})",
+            [rid] + chunk
+        )
+        found.update(r[0] for r in rows)
+    return found
+
+
+def _apply(sp: spotipy.Spotify, conn: sqlite3.Connection, rid: str, entry: Dict,
+           adds: Dict[str, str], removes: List[str]) -> Tuple[int, int]:
+    """Push add/remove batches, recording each batch only once Spotify accepted it.
+
+    Whatever is left after a failed batch goes to the pending table and is
+    retried first on the next sync, so the cursor can move on without losing
+    tracks or re-adding pushed ones. Only the rows for the tracks involved
+    are read or written.
+    """
+    pending = conn.execute('SELECT track_id, action, added_at FROM pending WHERE rule_id = ?', (rid,)).fetchall()
+    conn.execute('DELETE FROM pending WHERE rule_id = ?', (rid,))
+    removes = list(dict.fromkeys([t for t, act, _ in pending if act == 'remove'] + removes))
+    adds = {**{t: a for t, act, a in pending if act == 'add'}, **adds}
+    added = removed = 0
+
+    for i in range(0, len(removes), BATCH_SIZE):
+        batch = removes[i:i + BATCH_SIZE]
+        try:
+            sp.playlist_remove_all_occurrences_of_items(entry['playlist_id'], [f"spotify:track:{t}" for t in batch])
+        except Exception as e:
+            print(f"Error removing tracks from smart playlist: {e}")
+            conn.executemany(
+                "INSERT OR REPLACE INTO pending (rule_id, track_id, action, added_at) VALUES (?, ?, 'remove', '')",
+                [(rid, t) for t in removes[i:]]
+            )
+            break
+        conn.executemany('DELETE FROM members WHERE rule_id = ? AND track_id = ?', [(rid, t) for t in batch])
+        removed += len(batch)
+
+    if _is_window(entry):
+        cutoff = _cutoff(entry['rule']['added_within_days'])
+        adds = {t: a for t, a in adds.items() if a >= cutoff}
+    present = _members_among(conn, rid, list(adds))
+    todo = [(t, a) for t, a in adds.items() if t not in present]
+    for i in range(0, len(todo), BATCH_SIZE):
+        batch = todo[i:i + BATCH_SIZE]
+        try:
+            sp.playlist_add_items(entry['playlist_id'], [f"spotify:track:{t}" for t, _ in batch])
+        except Exception as e:
+            print(f"Error adding tracks to smart playlist: {e}")
+            conn.executemany(
+                "INSERT OR REPLACE INTO pending (rule_id, track_id, action, added_at) VALUES (?, ?, 'add', ?)",
+                [(rid, t, a) for t, a in todo[i:]]
+            )
+            break
+        conn.executemany(
+            'INSERT OR REPLACE INTO members (rule_id, track_id, added_at) VALUES (?, ?, ?)',
+            [(rid, t, a) for t, a in batch]
+        )
+        added += len(batch)
+
+    conn.commit()
+    return added, removed
+
+
+def _expired(conn: sqlite3.Connection, rid: str, entry: Dict, now: datetime.datetime) -> List[str]:
+    """Window-rule members older than the cutoff, read off the old end of the added_at index"""
+    rows = conn.execute(
+        'SELECT track_id FROM members WHERE rule_id = ? AND added_at < ?',
+        (rid, _cutoff(entry['rule']['added_within_days'], now))
+    )
+    return [r[0] for r in rows]
+
+
+def list_smart_playlists(user_id: str) -> List[Dict]:
+    conn = _connect()
+    try:
+        rows = conn.execute(
+            'SELECT r.rule_id, r.name, r.rule, r.playlist_id,'
+            ' (SELECT COUNT(*) FROM members m WHERE m.rule_id = r.rule_id)'
+            ' FROM rules r WHERE r.user_id = ?', (user_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [
+        {'id': rid, 'name': name, 'rule': json.loads(rule), 'playlist_id': pid, 'track_count': count}
+        for rid, name, rule, pid, count in rows
+    ]
+
+
+def create_smart_playlist(sp: spotipy.Spotify, name: str, rule: Dict) -> Optional[Dict]:
+    """Create the Spotify playlist and fill it from the whole library once.
+
+    The library is listed strictly, so a failed page aborts before anything
+    is created. The rule is invisible to syncs until it is inserted at the
+    end, so the user's lock is only held for that final write.
+    """
+    usr = sp.current_user()
+    songs = get_user_liked_songs(sp, strict=True)
+    pl = create_playlist(sp, usr['id'], name, "Smart playlist kept in sync with liked songs")
+    if not pl:
+        return None
+
+    rid = uuid.uuid4().hex[:8]
+    entry = {'name': name, 'rule': rule, 'playlist_id': pl['id']}
+    conn = _connect()
+    try:
+        matches = _match(sp, songs, {rid: entry}, None)[rid]
+        _apply(sp, conn, rid, entry, matches, [])
+
+        with file_lock(_user_lock(usr['id'])):
+            state = _load_user(conn, usr['id'])
+            if state is None or not _load_rules(conn, usr['id']):
+                # First rule (again): start the delta cursor from this listing
+                cursor, cursor_ids = _cursor(songs)
+                _save_user(conn, usr['id'], {'cursor': cursor or None, 'cursor_ids': cursor_ids, 'total': len(songs)})
+            conn.execute(
+                'INSERT INTO rules (rule_id, user_id, name, rule, playlist_id) VALUES (?, ?, ?, ?, ?)',
+                (rid, usr['id'], name, json.dumps(rule), pl['id'])
+            )
+            conn.commit()
+        count = conn.execute('SELECT COUNT(*) FROM members WHERE rule_id = ?', (rid,)).fetchone()[0]
+    finally:
+        conn.close()
+    return {'id': rid, 'name': name, 'playlist_id': pl['id'], 'track_count': count}
+
+
+def delete_smart_playlist(user_id: str, rule_id: str) -> bool:
+    """Stop maintaining a smart playlist; the Spotify playlist itself is kept"""
+    conn = _connect()
+    try:
+        with file_lock(_user_lock(user_id)):
+            if not conn.execute('DELETE FROM rules WHERE rule_id = ? AND user_id = ?', (rule_id, user_id)).rowcount:
+                return False
+            conn.execute('DELETE FROM members WHERE rule_id = ?', (rule_id,))
+            conn.execute('DELETE FROM pending WHERE rule_id = ?', (rule_id,))
+            conn.commit()
+    finally:
+        conn.close()
+    return True
+
+
+def sync_smart_playlists(sp: spotipy.Spotify, user_id: str) -> Dict[str, any]:
+    """Bring every smart playlist up to date with the liked library.
+
+    Normally only songs liked since the last sync are fetched and tested,
+    window rules read aged-out members off the old end of an added_at index,
+    and only the member rows that changed are written, so the cost follows
+    the size of the change. If the library total shows songs were unliked,
+    the library is re-listed once and memberships are diffed instead; a
+    failed page aborts the sync rather than diffing against a partial list.
+    Syncs are serialized per user, never across users.
+    """
+    conn = _connect()
+    try:
+        with file_lock(_user_lock(user_id)):
+            return _sync(sp, conn, user_id)
+    finally:
+        conn.close()
+
+
+def _sync(sp: spotipy.Spotify, conn: sqlite3.Connection, user_id: str) -> Dict[str, any]:
+    state = _load_user(conn, user_id)
+    rules = _load_rules(conn, user_id)
+    if not state or not rules:
+        return {'rules': 0, 'new_tracks': 0, 'tracks_added': 0, 'tracks_removed': 0, 'full_rescan': False}
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    delta, total = get_liked_songs_since(sp, state['cursor'], state['cursor_ids'])
+    full = total != state['total'] + len(delta)
+
+    if full:
+        items = get_user_liked_songs(sp, strict=True)
+        total = len(items)
+    else:
+        items = delta
+    matches = _match(sp, items, rules, now) if items else {rid: {} for rid in rules}
+
+    has_pending = {r[0] for r in conn.execute(
+        f"SELECT DISTINCT rule_id FROM pending WHERE rule_id IN ({','.join('?' * len(rules))})", list(rules)
+    )}
+    added = removed = 0
+    for rid, entry in rules.items():
+        if full:
+            members = {r[0] for r in conn.execute('SELECT track_id FROM members WHERE rule_id = ?', (rid,))}
+            removes = [t for t in members if t not in matches[rid]]
+        elif _is_window(entry):
+            removes = _expired(conn, rid, entry, now)
+        else:
+            removes = []
+        if not (matches[rid] or removes or rid in has_pending):
+            continue
+        a, r = _apply(sp, conn, rid, entry, matches[rid], removes)
+        added += a
+        removed += r
+
+    if items or total != state['total']:
+        if items:
+            cursor, cursor_ids = _cursor(items)
+            if cursor == state['cursor'] and not full:
+                cursor_ids = list(set(cursor_ids) | set(state['cursor_ids']))
+            state['cursor'], state['cursor_ids'] = cursor, cursor_ids
+        state['total'] = total
+        _save_user(conn, user_id, state)
+        conn.commit()
+
+    print(f"Synced {len(rules)} smart playlists from {len(items)} tracks: +{added} -{removed}")
+    return {
+        'rules': len(rules),
+        'new_tracks': len(delta),
+        'tracks_added': added,
+        'tracks_removed': removed,
+        'full_rescan': full
+    }
@@ -1,33 +1,12 @@
-from collections import Counter
-import datetime
-def get_song_statistics(sp, p='all'):
-    s = get_user_liked_songs(sp)
-    a, g, t = [], [], []
-    n = datetime.datetime.now()
-    for i in s:
-        tr = i.get('track')
-        if not tr:
-            continue
-        d = tr.get('album', {}).get('release_date', '')
-        if d:
-            try:
-                y = int(d[:4])
-            except Exception:
-                y = None
-        else:
-            y = None
-        if p == 'year' and y and y != n.year:
-            continue
-        if p == 'month' and y and y != n.year:
-            continue
-        if tr.get('artists'):
-            a.extend([x['name'] for x in tr['artists']])
-            g.extend(tr['artists'][0].get('genres', []))
-        t.append(tr['name'])
-    ta = Counter(a).most_common(10)
-    tg = Counter(g).most_common(10)
-    tt = Counter(t).most_common(10)
-    return {'top_artists': ta, 'top_genres': tg, 'top_tracks': tt}
+from .listening_history import ingest_recent_plays, get_listening_stats
+def get_song_statistics(sp, p='all', user_id=None):
+    # Real listening history: new plays are ingested, then the period is a rollup lookup
+    uid = user_id or sp.current_user()['id']
+    try:
+        ingest_recent_plays(sp, uid)
+    except Exception as e:
+        print(f"Error ingesting recently played tracks: {e}")
+    return get_listening_stats(uid, p)
 
 def get_smart_recommendations(sp, l=10):
     s = get_user_liked_songs(sp, limit=50)
@@ -54,10 +33,10 @@ def get_smart_recommendations(sp, l=10):
             'preview_url': tr.get('preview_url'),
         })
     return {'recommendations': sug}
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 import spotipy
 import json
-from .genre_cache import enrich_tracks_with_cached_genres
+from .genre_cache import enrich_tracks_with_cached_genres, update_track_genre_map, get_track_genres
 
 def get_user_playlists(sp):
     pls = []
@@ -85,7 +64,8 @@ def get_tracks_from_playlist(sp, pid):
     return tr
 
 
-def get_user_liked_songs(sp: spotipy.Spotify, limit: int = None) -> List[Dict]:
+def get_user_liked_songs(sp: spotipy.Spotify, limit: int = None, strict: bool = False) -> List[Dict]:
+    """All liked songs; a failed page ends the listing early unless `strict`, which re-raises"""
     tr = []
     batch = 50
     off = 0
@@ -109,12 +89,54 @@ def get_user_liked_songs(sp: spotipy.Spotify, limit: int = None) -> List[Dict]:
             
         except Exception as e:
             print(f"Error fetching liked songs at offset {off}: {e}")
+            if strict:
+                raise
             break
     
     print(f"Finished fetching liked songs. Total: {len(tr)}")
     return tr
 
 
+def get_liked_songs_since(sp: spotipy.Spotify, since: str = None, seen_ids: List[str] = None) -> Tuple[List[Dict], int]:
+    """Liked songs added at or after `since` (newest first) and the current library total.
+
+    Saved tracks come back newest first, so paging stops at the first track
+    older than the cursor. `seen_ids` are tracks already processed that share
+    the cursor's timestamp.
+    """
+    tr = []
+    total = 0
+    off = 0
+    seen = set(seen_ids or [])
+    
+    while True:
+        res = sp.current_user_saved_tracks(limit=50, offset=off)
+        if not res or not res['items']:
+            break
+        total = res['total']
+        
+        for item in res['items']:
+            added = item.get('added_at') or ''
+            if since and added < since:
+                return tr, total
+            if since and added == since and item.get('track') and item['track'].get('id') in seen:
+                continue
+            tr.append(item)
+        
+        if not res['next']:
+            break
+        off += 50
+    
+    return tr, total
+
+
+def get_liked_songs_version(sp: spotipy.Spotify) -> str:
+    # One-item probe: total count plus newest added_at changes on every like/unlike
+    res = sp.current_user_saved_tracks(limit=1)
+    newest = res['items'][0]['added_at'] if res and res['items'] else ''
+    return f"{res['total'] if res else 0}:{newest}"
+
+
 def get_current_playback(sp: spotipy.Spotify) -> Optional[Dict]:
     try:
         res = sp.current_playback()
@@ -124,8 +146,8 @@ def get_current_playback(sp: spotipy.Spotify) -> Optional[Dict]:
         return None
 
 
-def detect_duplicate_liked_songs(sp: spotipy.Spotify) -> List[Dict]:
-    songs = get_user_liked_songs(sp)
+def detect_duplicate_liked_songs(sp: spotipy.Spotify, strict: bool = False) -> List[Dict]:
+    songs = get_user_liked_songs(sp, strict=strict)
     
     grp = {}
     dup = []
@@ -196,17 +218,16 @@ def create_genre_playlists(sp: spotipy.Spotify, genre_filter: str = None) -> Dic
         usr = sp.current_user()
         songs = get_user_liked_songs(sp)
         
-        from .genre_cache import enrich_tracks_with_cached_genres
-        enr = enrich_tracks_with_cached_genres(sp, songs)
+        tmap = update_track_genre_map(sp, songs)
         
         gen_tr = {}
         
-        for item in enr:
+        for item in songs:
             tr = item.get('track')
             if not tr or not tr.get('artists'):
                 continue
                 
-            gen = tr['artists'][0].get('genres', [])
+            gen = get_track_genres(tmap, tr)
             for g in gen:
                 if genre_filter and genre_filter.lower() not in g.lower():
                     continue
@@ -263,15 +284,11 @@ def add_tracks_to_playlist(sp: spotipy.Spotify, playlist_id: str, uris: List[str
 def get_available_genres(sp: spotipy.Spotify) -> List[str]:
     try:
         songs = get_user_liked_songs(sp)
-        from .genre_cache import enrich_tracks_with_cached_genres
-        enr = enrich_tracks_with_cached_genres(sp, songs)
+        tmap = update_track_genre_map(sp, songs)
         
         all_gen = set()
-        for item in enr:
-            tr = item.get('track')
-            if tr and tr.get('artists'):
-                gen = tr['artists'][0].get('genres', [])
-                all_gen.update(gen)
+        for item in songs:
+            all_gen.update(get_track_genres(tmap, item))
         
         return sorted(list(all_gen))
     except Exception as e:
@@ -280,11 +297,12 @@ def get_available_genres(sp: spotipy.Spotify) -> List[str]:
 
 def get_playlist_genres(sp: spotipy.Spotify, playlist_id: str) -> Dict[str, int]:
     tr = get_tracks_from_playlist(sp, playlist_id)
+    tmap = update_track_genre_map(sp, tr)
     gen = {}
     
     for item in tr:
         if item['track'] and item['track']['artists']:
-            tr_gen = get_genres_for_track(sp, item)
+            tr_gen = get_track_genres(tmap, item)
             for g in tr_gen:
                 gen[g] = gen.get(g, 0) + 1
     